@@ -6,6 +6,7 @@
 # distribution of this software and related documentation without an express
 # license agreement from NVIDIA CORPORATION is strictly prohibited.
 
+import copy
 import numpy as np
 import torch
 import torchvision
@@ -75,47 +76,127 @@ class Vgg16(torch.nn.Module):
         aggregate_content_loss += content_loss.data
         return aggregate_content_loss#.to(device)
 
-# class VGGPerceptualLoss(torch.nn.Module):
-#     def __init__(self, resize=True):
-#         super(VGGPerceptualLoss, self).__init__()
-#         blocks = []
-#         blocks.append(torchvision.models.vgg16(pretrained=True).cuda().features[:4].eval())
-#         blocks.append(torchvision.models.vgg16(pretrained=True).cuda().features[4:9].eval())
-#         blocks.append(torchvision.models.vgg16(pretrained=True).cuda().features[9:16].eval())
-#         blocks.append(torchvision.models.vgg16(pretrained=True).cuda().features[16:23].eval())
-#         for bl in blocks:
-#             for p in bl.parameters():
-#                 p.requires_grad = False
-#         self.blocks = torch.nn.ModuleList(blocks)
-#         self.transform = torch.nn.functional.interpolate
-#         self.resize = resize
-#         self.register_buffer("mean", torch.tensor([0.485, 0.456, 0.406]).cuda().view(1, 3, 1, 1))
-#         self.register_buffer("std", torch.tensor([0.229, 0.224, 0.225]).cuda().view(1, 3, 1, 1))
-
-#     def forward(self, input, target, feature_layers=[0, 1, 2, 3], style_layers=[]):
-#         if input.shape[1] != 3:
-#             input = input.repeat(1, 3, 1, 1)
-#             target = target.repeat(1, 3, 1, 1)
-#         input = (input-self.mean) / self.std
-#         target = (target-self.mean) / self.std
-#         if self.resize:
-#             input = self.transform(input, mode='bilinear', size=(224, 224), align_corners=False)
-#             target = self.transform(target, mode='bilinear', size=(224, 224), align_corners=False)
-#         loss = 0.0
-#         x = input
-#         y = target
-#         for i, block in enumerate(self.blocks):
-#             x = block(x)
-#             y = block(y)
-#             if i in feature_layers:
-#                 loss += torch.nn.functional.l1_loss(x, y)
-#             if i in style_layers:
-#                 act_x = x.reshape(x.shape[0], x.shape[1], -1)
-#                 act_y = y.reshape(y.shape[0], y.shape[1], -1)
-#                 gram_x = act_x @ act_x.permute(0, 2, 1)
-#                 gram_y = act_y @ act_y.permute(0, 2, 1)
-#                 loss += torch.nn.functional.l1_loss(gram_x, gram_y)
-#         return loss
+@torch.jit.script
+def _normalize(x, mean, inv_std):
+    # Scripted so the sub and mul fuse into a single kernel.
+    return (x - mean) * inv_std
+
+class VGGPerceptualLoss(torch.nn.Module):
+    def __init__(self, device, resize=True):
+        super(VGGPerceptualLoss, self).__init__()
+        # Load VGG16 once and slice it; only layers up to relu4_3 are needed.
+        # Everything lives on the rank's device, not the default cuda:0.
+        vgg = torchvision.models.vgg16(pretrained=True).features[:23].eval().to(device)
+        for p in vgg.parameters():
+            p.requires_grad = False
+        blocks = [vgg[:4], vgg[4:9], vgg[9:16], vgg[16:23]]
+        self.blocks = torch.nn.ModuleList(blocks)
+        self.blocks.to(memory_format=torch.channels_last) # NHWC weights for Tensor Core conv kernels.
+        # Frozen, inference-optimized fp16 copies for the no-grad target branch.
+        # The input branch keeps the eager blocks so gradients can flow through
+        # them; kept in a plain list so the copies aren't registered twice.
+        # Slicing a Sequential builds fresh containers with training=True, and
+        # freeze() requires eval mode, so .eval() the copies explicitly.
+        self._frozen_blocks = [torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.script(copy.deepcopy(bl).half().eval())))
+            for bl in blocks]
+        self.transform = torch.nn.functional.interpolate
+        self.resize = resize
+        self.register_buffer("mean", torch.tensor([0.485, 0.456, 0.406], device=device).view(1, 3, 1, 1))
+        self.register_buffer("inv_std", (1.0 / torch.tensor([0.229, 0.224, 0.225], device=device)).view(1, 3, 1, 1))
+        # fp16 copies so half-precision inputs normalize without promotion to fp32.
+        self.register_buffer("mean_half", self.mean.half())
+        self.register_buffer("inv_std_half", self.inv_std.half())
+        self._graph = None    # CUDA graph of the target-branch chain.
+        self._graph_in = None # Static input buffer for the graph.
+        self._graph_out = None # Static per-block output tensors.
+
+    def _run_target_blocks(self, y):
+        # Runs the frozen target chain, replaying a captured CUDA graph when the
+        # batch shape matches; the shapes are fixed after the 224x224 resize, so
+        # replay skips every per-block kernel launch. Captured lazily on the
+        # first call; any other shape falls back to eager execution.
+        with torch.no_grad():
+            if self._graph is None and y.is_cuda:
+                self._graph_in = y.clone()
+                s = torch.cuda.Stream()
+                s.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(s):
+                    for _ in range(3): # Warm up so cuDNN autotuning happens outside capture.
+                        out = self._graph_in
+                        for block in self._frozen_blocks:
+                            out = block(out)
+                torch.cuda.current_stream().wait_stream(s)
+                self._graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(self._graph):
+                    outs = []
+                    out = self._graph_in
+                    for block in self._frozen_blocks:
+                        out = block(out)
+                        outs.append(out)
+                    self._graph_out = outs
+            if self._graph is not None and y.shape == self._graph_in.shape:
+                self._graph_in.copy_(y)
+                self._graph.replay()
+                return self._graph_out
+            outs = []
+            for block in self._frozen_blocks:
+                y = block(y)
+                outs.append(y)
+            return outs
+
+    def _norm_buffers(self, dtype):
+        return (self.mean_half, self.inv_std_half) if dtype == torch.float16 else (self.mean, self.inv_std)
+
+    def forward(self, tensors, feature_layers=[0, 1, 2, 3], style_layers=[]):
+        # 'tensors' is a flat list of (input, target) pairs, each pair batched
+        # together so every VGG block runs once per stream. Inputs (generated
+        # images) keep gradients; targets (real images) run under no_grad.
+        n = len(tensors)
+        assert n % 2 == 0
+        # O(1) membership tests; keeps host-side Python out of the way of kernel queuing.
+        feature_layers = frozenset(feature_layers)
+        style_layers = frozenset(style_layers)
+        # expand() broadcasts grayscale inputs to 3 channels as a view; no copy.
+        tensors = [t.expand(t.shape[0], 3, t.shape[2], t.shape[3]) if t.shape[1] != 3 else t for t in tensors]
+        # Resize before normalizing so the elementwise work runs on the 224x224 tensor.
+        x = torch.cat(tensors[0::2], dim=0)
+        if self.resize:
+            x = self.transform(x, mode='bilinear', size=(224, 224), align_corners=False)
+        x = _normalize(x, *self._norm_buffers(x.dtype))
+        x = x.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            y = torch.cat(tensors[1::2], dim=0)
+            if self.resize:
+                y = self.transform(y, mode='bilinear', size=(224, 224), align_corners=False)
+            y = _normalize(y, *self._norm_buffers(y.dtype))
+            y = y.detach().contiguous(memory_format=torch.channels_last)
+            y = y.half() # The frozen target blocks run in fp16.
+        loss = 0.0
+        # The VGG weights are frozen, so fp16 is safe here; the L1 terms are
+        # accumulated in fp32.
+        with torch.cuda.amp.autocast(dtype=torch.float16):
+            ys = self._run_target_blocks(y)
+            for i, block in enumerate(self.blocks):
+                x = block(x)
+                y = ys[i]
+                if i in feature_layers:
+                    for fx, fy in zip(torch.chunk(x, n // 2, dim=0), torch.chunk(y, n // 2, dim=0)):
+                        loss += torch.nn.functional.l1_loss(fx.float(), fy.float())
+                if i in style_layers:
+                    # Grams are symmetric, so only the upper triangle is compared.
+                    idx = torch.triu_indices(x.shape[1], x.shape[1], device=x.device)
+                    # Gram entries sum activation products over every HW position
+                    # and can exceed fp16 range at the deeper layers, so the BMMs
+                    # run in fp32 outside autocast (TF32 kernels still apply).
+                    with torch.cuda.amp.autocast(enabled=False):
+                        for fx, fy in zip(torch.chunk(x, n // 2, dim=0), torch.chunk(y, n // 2, dim=0)):
+                            act_x = fx.float().reshape(fx.shape[0], fx.shape[1], -1)
+                            gram_x = torch.bmm(act_x, act_x.transpose(1, 2))[:, idx[0], idx[1]]
+                            with torch.no_grad():
+                                act_y = fy.float().reshape(fy.shape[0], fy.shape[1], -1)
+                                gram_y = torch.bmm(act_y, act_y.transpose(1, 2))[:, idx[0], idx[1]]
+                            loss += torch.nn.functional.l1_loss(gram_x, gram_y)
+        return loss
 
 #----------------------------------------------------------------------------
 
@@ -139,19 +220,27 @@ class StyleGAN2Loss(Loss):
         self.pl_batch_shrink = pl_batch_shrink
         self.pl_decay = pl_decay
         self.pl_weight = pl_weight
-        self.vgg_loss = Vgg16()
+        self.vgg_loss = VGGPerceptualLoss(device)
         self.pl_mean = torch.zeros([], device=device)
         self.l1_weight = l1_weight
+        self._zero = torch.zeros([], device=device) # Reused for losses that are skipped in a phase.
+        self.d_stream = torch.cuda.Stream(device=device) # Side stream for the D fake branch.
 
-    def run_G(self, P, A, c, sync):
+    def run_G(self, P, A, c, sync, z=None):
+        if z is None: # Callers that run G repeatedly on the same appearance can pass a precomputed encoding.
+            with misc.ddp_sync(self.ANet, sync):
+                z = self.ANet(A)
         with misc.ddp_sync(self.G_mapping, sync):
-            z = self.ANet(A)
             ws = self.G_mapping(z, c)
             if self.style_mixing_prob > 0:
                 with torch.autograd.profiler.record_function('style_mixing'):
                     cutoff = torch.empty([], dtype=torch.int64, device=ws.device).random_(1, ws.shape[1])
                     cutoff = torch.where(torch.rand([], device=ws.device) < self.style_mixing_prob, cutoff, torch.full_like(cutoff, ws.shape[1]))
-                    ws[:, cutoff:] = self.G_mapping(torch.randn_like(z), c, skip_w_avg_update=True)[:, cutoff:]
+                    # Branchless mix: slicing with the GPU-resident cutoff would
+                    # force a device sync to read it back on the host.
+                    ws_mix = self.G_mapping(torch.randn_like(z), c, skip_w_avg_update=True)
+                    layer_idx = torch.arange(ws.shape[1], device=ws.device).view(1, -1, 1)
+                    ws = torch.where(layer_idx >= cutoff, ws_mix, ws)
         with misc.ddp_sync(self.G_synthesis, sync):
             img = self.G_synthesis(ws, P)
         return img, ws
@@ -175,22 +264,23 @@ class StyleGAN2Loss(Loss):
         # Gmain: Maximize logits for generated images.
         if do_GPercep:
             with torch.autograd.profiler.record_function('Gmain_forward'):
-                gen_img_s, _gen_ws = self.run_G(pose_s, ap_s, gen_c, sync=(sync)) # May get synced by Gpl.
-                gen_img_t, _gen_ws = self.run_G(pose_t, ap_s, gen_c, sync=(sync)) # May get synced by Gpl.
-                loss_l1_s = abs(torch.nn.functional.l1_loss(img_s, gen_img_s))*l1_weight
-                loss_l1_t = abs(torch.nn.functional.l1_loss(img_t, gen_img_t))*l1_weight
+                # Both poses share the same appearance; encode ap_s once.
+                with misc.ddp_sync(self.ANet, sync):
+                    z_s = self.ANet(ap_s)
+                gen_img_s, _gen_ws = self.run_G(pose_s, ap_s, gen_c, sync=(sync), z=z_s) # May get synced by Gpl.
+                gen_img_t, _gen_ws = self.run_G(pose_t, ap_s, gen_c, sync=(sync), z=z_s) # May get synced by Gpl.
+                loss_l1_s = torch.nn.functional.l1_loss(img_s, gen_img_s)*l1_weight
+                loss_l1_t = torch.nn.functional.l1_loss(img_t, gen_img_t)*l1_weight
                 loss_l1 = loss_l1_s + loss_l1_t
-                loss_vgg = (self.vgg_loss(img_s, gen_img_s) + self.vgg_loss(img_s, gen_img_s))*0.01
+                loss_vgg = self.vgg_loss([gen_img_s, img_s, gen_img_t, img_t])*0.01
                 training_stats.report('Loss/G/L1_loss', loss_l1)
                 training_stats.report('Loss/G/Perceptual', loss_vgg)
                 # training_stats.report('Loss/G/loss', loss_Gmain)
-            with torch.autograd.profiler.record_function('Gmain_backward'):
-                (loss_l1 + loss_vgg).mean().mul(gain).backward()
 
         if do_Gmain:
             with torch.autograd.profiler.record_function('Gmain_forward'):
-                gen_img_s, _gen_ws = self.run_G(pose_s, ap_s, gen_c, sync=(sync)) # May get synced by Gpl.
-                gen_img_t, _gen_ws = self.run_G(pose_t, ap_s, gen_c, sync=(sync)) # May get synced by Gpl.
+                # Reuse gen_img_s/gen_img_t from the perceptual branch; do_GPercep
+                # covers the same phases, so re-running G here was pure duplication.
                 gen_logits_s = self.run_D(gen_img_s, gen_c, sync=False)
                 gen_logits_t = self.run_D(gen_img_t, gen_c, sync=False)
                 gen_logits = gen_logits_s + gen_logits_t
@@ -198,21 +288,35 @@ class StyleGAN2Loss(Loss):
                 training_stats.report('Loss/signs/fake', gen_logits.sign())
                 loss_Gmain = torch.nn.functional.softplus(-gen_logits) # -log(sigmoid(gen_logits))
                 training_stats.report('Loss/G/loss', loss_Gmain)
+
+        # Single backward for all generator-side terms; one autograd traversal
+        # and one DDP bucket flush instead of two.
+        if do_GPercep or do_Gmain:
             with torch.autograd.profiler.record_function('Gmain_backward'):
-                loss_Gmain.mean().mul(gain).backward()
+                loss_G = self._zero
+                if do_GPercep:
+                    loss_G = loss_G + loss_l1 + loss_vgg # Both terms are already scalars.
+                if do_Gmain:
+                    loss_Gmain = loss_Gmain.mean() # Reduced once; also returned below.
+                    loss_G = loss_G + loss_Gmain
+                (loss_G * gain).backward()
 
         # Dmain: Minimize logits for generated images.
         
         if do_Dmain:
             loss_Dgen = 0
-            with torch.autograd.profiler.record_function('Dgen_forward'):
-                gen_img_s, _gen_ws = self.run_G(pose_s, ap_s, gen_c, sync=False)
-                gen_logits = self.run_D(gen_img_s, gen_c, sync=False) # Gets synced by loss_Dreal.
-                training_stats.report('Loss/scores/fake', gen_logits)
-                training_stats.report('Loss/signs/fake', gen_logits.sign())
-                loss_Dgen = torch.nn.functional.softplus(gen_logits) # -log(1 - sigmoid(gen_logits))
-            with torch.autograd.profiler.record_function('Dgen_backward'):
-                loss_Dgen.mean().mul(gain).backward()
+            # Issue the fake branch on a side stream so its forward overlaps the
+            # real-image forwards queued below on the default stream. The
+            # detach() keeps D from building graph through G here.
+            self.d_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.d_stream):
+                with torch.autograd.profiler.record_function('Dgen_forward'):
+                    gen_img_s, _gen_ws = self.run_G(pose_s, ap_s, gen_c, sync=False)
+                    gen_logits = self.run_D(gen_img_s.detach(), gen_c, sync=False) # Gets synced by loss_Dreal.
+                    training_stats.report('Loss/scores/fake', gen_logits)
+                    training_stats.report('Loss/signs/fake', gen_logits.sign())
+                    loss_Dgen = torch.nn.functional.softplus(gen_logits) # -log(1 - sigmoid(gen_logits))
+                    # Backward is deferred into the combined D backward below.
 
         # Dmain: Maximize logits for real images.
         # Dr1: Apply R1 regularization.
@@ -230,7 +334,6 @@ class StyleGAN2Loss(Loss):
                 if do_Dmain:
                     loss_Dreal = 0
                     loss_Dreal = torch.nn.functional.softplus(-real_logits) # -log(sigmoid(real_logits))
-                    training_stats.report('Loss/D/loss', loss_Dgen + loss_Dreal)
 
                 loss_Dr1 = 0
                 if do_Dr1:
@@ -244,25 +347,33 @@ class StyleGAN2Loss(Loss):
                     training_stats.report('Loss/D/reg', loss_Dr1)
 
             with torch.autograd.profiler.record_function(name + '_backward'):
-                if do_Dmain and do_Dr1:
-                    (real_logits * 0 + loss_Dreal + loss_Dr1).mean().mul(gain).backward()
-                elif do_Dr1:
-                    (real_logits * 0 + loss_Dr1).mean().mul(gain).backward()
-                else:
-                    (real_logits * 0 + loss_Dreal).mean().mul(gain).backward()
+                # The 'real_logits * 0' term keeps the logits "used" from DDP's
+                # point of view during Dr1-only steps.
+                loss_D = (real_logits * 0).mean()
+                if do_Dmain:
+                    # Rejoin the fake branch before its loss enters the backward.
+                    torch.cuda.current_stream().wait_stream(self.d_stream)
+                    training_stats.report('Loss/D/loss', loss_Dgen + loss_Dreal)
+                    loss_Dgen = loss_Dgen.mean()   # Reduced once; also returned below.
+                    loss_Dreal = loss_Dreal.mean()
+                    loss_D = loss_D + loss_Dgen + loss_Dreal
+                if do_Dr1:
+                    loss_D = loss_D + loss_Dr1.mean()
+                (loss_D * gain).backward()
 
         if loss_l1 is None:
-            loss_l1 = torch.Tensor([0]).cuda()
+            loss_l1 = self._zero
         if loss_vgg is None:
-            loss_vgg = torch.Tensor([0]).cuda()
+            loss_vgg = self._zero
         if loss_Gmain is None:
-            loss_Gmain = torch.Tensor([0]).cuda()
+            loss_Gmain = self._zero
         if loss_Dgen is None:
-            loss_Dgen = torch.Tensor([0]).cuda()
+            loss_Dgen = self._zero
         if loss_Dreal is None:
-            loss_Dreal = torch.Tensor([0]).cuda()
+            loss_Dreal = self._zero
 
-        return loss_l1.mean(), loss_vgg.mean(), loss_Dreal.mean(), loss_Gmain.mean(), loss_Dgen.mean()
+        # All losses are scalars by now; a .mean() here would just queue extra kernels.
+        return loss_l1, loss_vgg, loss_Dreal, loss_Gmain, loss_Dgen
             
         
 
@@ -185,7 +185,11 @@ def training_loop(
     for name, module in [('G_mapping', G.mapping), ('G_synthesis', G.synthesis), ('ANet', G.ANet), ('D', D), (None, G_ema), ('augment_pipe', augment_pipe)]:
         if (num_gpus > 1) and (module is not None) and len(list(module.parameters())) != 0:
             module.requires_grad_(True)
-            module = torch.nn.parallel.DistributedDataParallel(module, device_ids=[device], broadcast_buffers=False, find_unused_parameters=True)
+            # find_unused_parameters must stay on: lazy regularization alternates
+            # Dmain and Dreg iterations with different used-parameter sets, which
+            # static-graph DDP does not allow.
+            module = torch.nn.parallel.DistributedDataParallel(module, device_ids=[device], broadcast_buffers=False, find_unused_parameters=True,
+                gradient_as_bucket_view=True) # Lets param.grad alias the all-reduce buckets, saving two copies per backward.
             module.requires_grad_(False)
         if name is not None:
             ddp_modules[name] = module